@@ -28,7 +28,7 @@ SOFTWARE.
 """
 
 import struct
-from functools import cache
+from array import array
 from PIL import Image, ImageFile
 
 
@@ -46,15 +46,212 @@ QOI_OP_RUN = 0xC0
 QOI_OP_MASK = 0b11000000
 QOI_EOF_MARKER = b'\x00\x00\x00\x00\x00\x00\x00\x01'
 
+# Channel differences carried by the DIFF and LUMA ops, modulo 256. The
+# DIFF and green LUMA tables are indexed by the op tag, the red and blue
+# LUMA tables by the second byte of the op.
+_DIFF_DR = bytes((tag >> 4 & 0b11) - 2 & 0xFF for tag in range(256))
+_DIFF_DG = bytes((tag >> 2 & 0b11) - 2 & 0xFF for tag in range(256))
+_DIFF_DB = bytes((tag & 0b11) - 2 & 0xFF for tag in range(256))
+_LUMA_DG = bytes((tag & 0b111111) - 32 & 0xFF for tag in range(256))
+_LUMA_DR_DG = bytes((diffs >> 4) - 8 & 0xFF for diffs in range(256))
+_LUMA_DB_DG = bytes((diffs & 0b1111) - 8 & 0xFF for diffs in range(256))
+
+# Initial content of the colour cache, 64 zeroed packed pixels
+_EMPTY_CACHE = array('I', [0] * 64)
+
 
 def _accept(prefix):
     return prefix[:4] == QOI_MAGIC
 
 
-@cache
-def _pixel_hash(pixel):
-    r, g, b, a = pixel
-    return (r * 3 + g * 5 + b * 7 + a * 11) % 64
+def _pixel_hash(value):
+    # (r * 3 + g * 5 + b * 7 + a * 11) % 64 for a pixel packed as
+    # r | g << 8 | b << 16 | a << 24: r and b, then g and a, are spread 16
+    # bits apart so a single multiply sums each pair without carries.
+    return ((value & 0xFF00FF) * 0x30007
+            + (value >> 8 & 0xFF00FF) * 0x5000B) >> 16 & 0x3F
+
+
+def _decode_stream(buffer, out, pos, cache, pixel):
+    """
+    Decode the QOI ops of buffer into out as RGBA, starting at byte offset pos
+
+    Decoding stops once out is full or the ops run into the 8 bytes of the
+    end marker. Pixels are packed as r | g << 8 | b << 16 | a << 24. Returns
+    the new offset in out and the last decoded pixel.
+    """
+    r = pixel & 0xFF
+    g = pixel >> 8 & 0xFF
+    b = pixel >> 16 & 0xFF
+    a = pixel >> 24
+    diff_dr, diff_dg, diff_db = _DIFF_DR, _DIFF_DG, _DIFF_DB
+    luma_dg, luma_dr_dg, luma_db_dg = _LUMA_DG, _LUMA_DR_DG, _LUMA_DB_DG
+    pixel_hash = _pixel_hash
+    stop = len(buffer) - len(QOI_EOF_MARKER)
+    size = len(out)
+    i = 0
+    while pos < size and i < stop:
+        tag = buffer[i]
+        if tag == QOI_OP_RGBA:
+            r, g, b, a = buffer[i+1:i+5]
+            i += 5
+
+        elif tag == QOI_OP_RGB:
+            r, g, b = buffer[i+1:i+4]
+            i += 4
+
+        elif tag & QOI_OP_MASK == QOI_OP_INDEX:
+            pixel = cache[tag & ~QOI_OP_MASK]
+            if not pixel:
+                # a never written slot holds (0, 0, 0, 0), which hashes to 0
+                cache[0] = 0
+            r = pixel & 0xFF
+            g = pixel >> 8 & 0xFF
+            b = pixel >> 16 & 0xFF
+            a = pixel >> 24
+            i += 1
+
+        elif tag & QOI_OP_MASK == QOI_OP_DIFF:
+            r = (r + diff_dr[tag]) & 0xFF
+            g = (g + diff_dg[tag]) & 0xFF
+            b = (b + diff_db[tag]) & 0xFF
+            i += 1
+
+        elif tag & QOI_OP_MASK == QOI_OP_LUMA:
+            dg = luma_dg[tag]
+            diffs = buffer[i+1]
+            r = (r + luma_dr_dg[diffs] + dg) & 0xFF
+            g = (g + dg) & 0xFF
+            b = (b + luma_db_dg[diffs] + dg) & 0xFF
+            i += 2
+        elif tag & QOI_OP_MASK == QOI_OP_RUN:
+            # the pixel and the cache are unchanged, only repeat the bytes
+            run = (tag & ~QOI_OP_MASK) + 1
+            end = min(pos + run * 4, size)
+            out[pos:end] = bytes((r, g, b, a)) * ((end - pos) // 4)
+            pos = end
+            i += 1
+            continue
+
+        out[pos] = r
+        out[pos+1] = g
+        out[pos+2] = b
+        out[pos+3] = a
+        pos += 4
+        if tag & QOI_OP_MASK != QOI_OP_INDEX:
+            # an indexed pixel is already in the cache at its own hash,
+            # except (0, 0, 0, 0) read from an unwritten slot, handled above
+            pixel = r | g << 8 | b << 16 | a << 24
+            cache[pixel_hash(pixel)] = pixel
+    return pos, r | g << 8 | b << 16 | a << 24
+
+
+def _run_length(raster, offset, pixel, limit):
+    """
+    Count the consecutive pixels of raster from byte offset that are equal
+    to pixel (as bytes), up to limit
+
+    Spans of doubling length are compared as whole slices, then the span
+    holding the first mismatch is bisected.
+    """
+    size = len(pixel)
+    low, high = 0, 1
+    while (high <= limit
+           and raster[offset:offset + high * size] == pixel * high):
+        low, high = high, high * 2
+    high = min(high, limit + 1)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if raster[offset:offset + middle * size] == pixel * middle:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def _encode_chunk(buffer, raster, channels, cache, previous_pixel, offset):
+    """
+    Encode the pixels of raster from byte offset into buffer, until the
+    image or the buffer is exhausted
+
+    Pixels are packed as r | g << 8 | b << 16 | a << 24. Returns the number
+    of bytes written and the updated encoder state.
+    """
+    pixel_hash = _pixel_hash
+    run_length = _run_length
+    from_bytes = int.from_bytes
+    # RGB rasters have no alpha byte, their pixels are opaque
+    opaque = 0xFF000000 if channels == 3 else 0
+    size = len(raster)
+    stop = len(buffer) - 6
+    i = 0
+    while offset < size and i < stop:
+        end = offset + channels
+        value = from_bytes(raster[offset:end], 'little') | opaque
+
+        if value == previous_pixel:
+            # run, measured and written whole, longer runs continue with
+            # another op on the next iteration
+            run = run_length(raster,
+                             offset,
+                             raster[offset:end],
+                             min(62, (size - offset) // channels))
+            buffer[i] = QOI_OP_RUN | (run - 1)
+            i += 1
+            offset += run * channels
+            continue
+
+        index = pixel_hash(value)
+        if value == cache[index]:
+            # index
+            buffer[i] = QOI_OP_INDEX | index
+            i += 1
+
+        elif (value ^ previous_pixel) >> 24 == 0:
+            # channel differences biased into the unsigned range of each op,
+            # a difference fits an op when its biased value is small enough
+            dr = (value & 0xFF) - (previous_pixel & 0xFF)
+            dg = (value >> 8 & 0xFF) - (previous_pixel >> 8 & 0xFF)
+            db = (value >> 16 & 0xFF) - (previous_pixel >> 16 & 0xFF)
+            dr_diff = (dr + 2) & 0xFF
+            dg_diff = (dg + 2) & 0xFF
+            db_diff = (db + 2) & 0xFF
+            dg_luma = (dg + 32) & 0xFF
+            dr_luma = (dr - dg + 8) & 0xFF
+            db_luma = (db - dg + 8) & 0xFF
+
+            if dr_diff | dg_diff | db_diff < 4:
+                # diff
+                buffer[i] = (QOI_OP_DIFF
+                             | dr_diff << 4
+                             | dg_diff << 2
+                             | db_diff)
+                i += 1
+
+            elif dg_luma | (dr_luma | db_luma) << 2 < 64:
+                # luma
+                buffer[i] = QOI_OP_LUMA | dg_luma
+                buffer[i+1] = dr_luma << 4 | db_luma
+                i += 2
+
+            else:
+                # rgb
+                buffer[i] = QOI_OP_RGB
+                buffer[i+1:i+4] = raster[offset:offset + 3]
+                i += 4
+
+        else:
+            # rgba, only reachable for RGBA images since RGB ones keep the
+            # initial 255 alpha
+            buffer[i] = QOI_OP_RGBA
+            buffer[i+1:i+5] = raster[offset:offset + 4]
+            i += 5
+
+        cache[index] = value
+        previous_pixel = value
+        offset = end
+
+    return i, previous_pixel, offset
 
 
 class QoiImageFile(ImageFile.ImageFile):
@@ -80,84 +277,53 @@ class QoiDecoder(ImageFile.PyDecoder):
     Decoder for QOI image files
     """
 
+    _pulls_fd = True
+
     def __init__(self, mode, *args):
         super().__init__(mode, args)
-        self.current_pixel = (0, 0, 0, 255)
-        self.cache = [(0, 0, 0, 0) for _ in range(64)]
-        self.x = 0
-        self.y = 0
+        self.current_pixel = 0xFF000000
+        self.cache = array('I', _EMPTY_CACHE)
+        self.channels = len(mode)
+        self.out = bytearray()
+        self.pos = 0
+
+    def setimage(self, im, extents=None):
+        super().setimage(im, extents)
+        size = self.state.xsize * self.state.ysize * 4
+        if len(self.out) != size:
+            self.out = bytearray(size)
 
     def decode(self, buffer):
-        i = 0
-        while i + 5 < len(buffer):
-            if buffer[i:i+8] == QOI_EOF_MARKER:
-                return -1, 0
-            tag = buffer[i]
-            if tag == QOI_OP_RGBA:
-                self.current_pixel = (buffer[i+1],
-                                      buffer[i+2],
-                                      buffer[i+3],
-                                      buffer[i+4])
-                i += 5
-
-            elif tag == QOI_OP_RGB:
-                self.current_pixel = (buffer[i+1],
-                                      buffer[i+2],
-                                      buffer[i+3],
-                                      self.current_pixel[3])
-                i += 4
-
-            elif tag & QOI_OP_MASK == QOI_OP_INDEX:
-                self.current_pixel = self.cache[tag & ~QOI_OP_MASK]
-                i += 1
-
-            elif tag & QOI_OP_MASK == QOI_OP_DIFF:
-                dr = (tag >> 4 & 0b11) - 2
-                dg = (tag >> 2 & 0b11) - 2
-                db = (tag & 0b11) - 2
-                self.current_pixel = ((self.current_pixel[0] + dr) % 256,
-                                      (self.current_pixel[1] + dg) % 256,
-                                      (self.current_pixel[2] + db) % 256,
-                                      self.current_pixel[3])
-                i += 1
-
-            elif tag & QOI_OP_MASK == QOI_OP_LUMA:
-                dg = (tag & ~QOI_OP_MASK) - 32
-                diffs = buffer[i+1]
-                dr = (diffs >> 4) - 8 + dg
-                db = (diffs & 0b1111) - 8 + dg
-                self.current_pixel = ((self.current_pixel[0] + dr) % 256,
-                                      (self.current_pixel[1] + dg) % 256,
-                                      (self.current_pixel[2] + db) % 256,
-                                      self.current_pixel[3])
-                i += 2
-            elif tag & QOI_OP_MASK == QOI_OP_RUN:
-                for _ in range((tag & ~QOI_OP_MASK) + 1):
-                    self._set_pixel()
-                i += 1
-                continue
-
-            self._set_pixel()
-            self.cache[_pixel_hash(self.current_pixel)] = self.current_pixel
-        return i, 0
+        # the whole stream is read at once, and the decoded raster is handed
+        # over to Pillow in a single call, RGB images drop the alpha bytes
+        # there as padding
+        self.pos, self.current_pixel = _decode_stream(self.fd.read(),
+                                                      self.out,
+                                                      self.pos,
+                                                      self.cache,
+                                                      self.current_pixel)
+        truncated = self.pos < len(self.out)
+        if truncated:
+            # the ops ran out before the last pixel, blank the rest of a
+            # buffer that may hold a previous image
+            self.out[self.pos:] = bytes(len(self.out) - self.pos)
+        self.set_as_raw(self.out,
+                        'RGBX' if self.channels == 3 else 'RGBA')
+        if truncated:
+            return -1, -2
+        return -1, 0
 
     def cleanup(self):
-        del self.cache
-        del self.current_pixel
-        del self.x
-        del self.y
-
-    def _set_pixel(self):
-        if self.im.mode == 'RGBA':
-            self.im.putpixel((self.x, self.y),
-                             self.current_pixel)
-        else:
-            self.im.putpixel((self.x, self.y),
-                             self.current_pixel[:3])
-        self.x += 1
-        if self.x >= self.im.size[0]:
-            self.y += 1
-            self.x = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Restore the initial decoding state in place, keeping the buffers
+        allocated so that the decoder can be reused
+        """
+        self.current_pixel = 0xFF000000
+        self.cache[:] = _EMPTY_CACHE
+        self.pos = 0
 
 
 class QoiEncoder(ImageFile.PyEncoder):
@@ -167,105 +333,59 @@ class QoiEncoder(ImageFile.PyEncoder):
 
     def __init__(self, mode, *args):
         super().__init__(mode, args)
-        self.previous_pixel = (0, 0, 0, 255)
-        self.cache = [(0, 0, 0, 0) for _ in range(64)]
-        self.x = 0
-        self.y = 0
-        self.run = 0
+        self.previous_pixel = 0xFF000000
+        self.cache = array('I', _EMPTY_CACHE)
+        self.channels = len(mode)
+        self.raster = b''
+        self.offset = 0
         self.eof = False
 
+    def setimage(self, im, extents=None):
+        super().setimage(im, extents)
+        self.raster = self._read_raster()
+
     def encode(self, bufsize):
         buffer = bytearray(bufsize)
-        i = 0
-        while not self.eof and i + 6 < bufsize:
-            pixel = self.im.getpixel((self.x, self.y))
-            if len(pixel) == 3:
-                pixel = pixel + (255, )
-            dr = pixel[0] - self.previous_pixel[0]
-            dg = pixel[1] - self.previous_pixel[1]
-            db = pixel[2] - self.previous_pixel[2]
-
-            if pixel == self.previous_pixel:
-                # run
-                self.run += 1
-                if self.run > 61:
-                    buffer[i] = QOI_OP_RUN | (self.run - 1)
-                    self.run = 0
-                    i += 1
-                self._advance_pixel()
-                continue
-
-            if self.run:
-                buffer[i] = QOI_OP_RUN | (self.run - 1)
-                self.run = 0
-                i += 1
-
-            if pixel == self.cache[_pixel_hash(pixel)]:
-                # index
-                buffer[i] = QOI_OP_INDEX | _pixel_hash(pixel)
-                i += 1
-
-            elif (pixel[3] == self.previous_pixel[3]
-                  and all((d + 2) % 256 < 4 for d in (dr, dg, db))):
-                # diff
-                buffer[i] = (QOI_OP_DIFF
-                             | (dr + 2) % 256 << 4
-                             | (dg + 2) % 256 << 2
-                             | (db + 2) % 256)
-                i += 1
-
-            elif (pixel[3] == self.previous_pixel[3]
-                  and (dg + 32) % 256 < 64
-                  and (dr - dg + 8) % 256 < 16
-                  and (db - dg + 8) % 256 < 16):
-                # luma
-                buffer[i] = QOI_OP_LUMA | (dg + 32) % 256
-                buffer[i+1] = (dr - dg + 8) % 256 << 4 | (db - dg + 8) % 256
-                i += 2
-
-            elif pixel[3] == self.previous_pixel[3]:
-                # rgb
-                buffer[i:i+4] = (struct.pack('BBBB',
-                                             QOI_OP_RGB,
-                                             pixel[0],
-                                             pixel[1],
-                                             pixel[2]))
-                i += 4
-
-            else:
-                # rgba
-                buffer[i:i+5] = (struct.pack('BBBBB',
-                                             QOI_OP_RGBA,
-                                             pixel[0],
-                                             pixel[1],
-                                             pixel[2],
-                                             pixel[3]))
-                i += 5
-
-            self.cache[_pixel_hash(pixel)] = pixel
-            self.previous_pixel = pixel
-            self._advance_pixel()
-
-        if self.eof and self.run:
-            buffer[i] = QOI_OP_RUN | (self.run - 1)
-            i += 1
-
+        i, self.previous_pixel, self.offset = _encode_chunk(
+            buffer,
+            self.raster,
+            self.channels,
+            self.cache,
+            self.previous_pixel,
+            self.offset)
+        self.eof = self.offset >= len(self.raster)
         return i, 1 if self.eof else 0, buffer
 
-    def _advance_pixel(self):
-        self.x += 1
-        if self.x >= self.im.size[0]:
-            self.y += 1
-            self.x = 0
-        self.eof = self.y >= self.im.size[1]
+    def _read_raster(self):
+        encoder = Image._getencoder(self.mode, 'raw', self.mode)
+        bufsize = max(ImageFile.MAXBLOCK, self.state.xsize * 4)
+        data = []
+        try:
+            encoder.setimage(self.im, self.state.extents())
+            while True:
+                l, s, d = encoder.encode(bufsize)
+                data.append(d[:l])
+                if s:
+                    break
+            if s < 0:
+                raise OSError(f"encoder error {s} when reading image data")
+        finally:
+            encoder.cleanup()
+        return b''.join(data)
 
     def cleanup(self):
-        del self.cache
-        del self.previous_pixel
-        del self.x
-        del self.y
-        del self.run
-        del self.eof
+        self.reset()
+
+    def reset(self):
+        """
+        Restore the initial encoding state in place so that the encoder can
+        be reused, the raster is read again by setimage
+        """
+        self.previous_pixel = 0xFF000000
+        self.cache[:] = _EMPTY_CACHE
+        self.raster = b''
+        self.offset = 0
+        self.eof = False
 
 
 def _save(im, fp, filename, save_all=False):